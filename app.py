@@ -1,289 +1,543 @@
 import streamlit as st
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, APITimeoutError, BadRequestError, NotFoundError, RateLimitError
 import requests
+import httpx
+from requests.adapters import HTTPAdapter
+
+# Must be the first Streamlit command of every run (before any st.error or cache spinner below)
+st.set_page_config(
+    page_title="AI-Powered Itinerary Organizer",
+    page_icon="✈️",
+    layout="wide"
+)
+
+
+# --- Shared, pooled HTTP connections (cached so Streamlit reruns reuse open TLS sessions) ---
+@st.cache_resource
+def _http_session():
+    """requests.Session used for OpenRouter REST calls outside the OpenAI SDK."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+    return session
+
+
+@st.cache_resource
+def _http_client():
+    """httpx.Client handed to the OpenAI SDK so its connection pool outlives a rerun."""
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        timeout=httpx.Timeout(120.0),
+    )
 
-load_dotenv()
 
 # --- Configure OpenRouter API ---
+if "env_loaded" not in st.session_state:
+    load_dotenv()  # os.environ is process-wide, so later reruns see the key without re-reading .env
+    st.session_state.env_loaded = True
+
+_API_KEY = os.getenv("OPENROUTER_API_KEY")
+
+if not _API_KEY:
+    st.error("OpenRouter API key not found in environment variables. "
+             "Please set OPENROUTER_API_KEY in your .env file locally.")
+    st.stop()
+
+
+@st.cache_resource
+def _openrouter_connection(api_key):
+    """
+    OpenAI client and the matching auth headers for direct REST calls, built together
+    from one key. Keyed on the key, so a changed OPENROUTER_API_KEY gets a fresh pair.
+    """
+    openrouter_client = OpenAI(
+        base_url="https://openrouter.ai/api/v1",
+        api_key=api_key,
+        http_client=_http_client(),
+    )
+    return openrouter_client, {"Authorization": f"Bearer {api_key}"}
+
+
 try:
-    openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
-    if openrouter_api_key:
-        client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=openrouter_api_key,
-        )
-    else:
-        st.error("OpenRouter API key not found in environment variables. "
-                 "Please set OPENROUTER_API_KEY in your .env file locally.")
-        st.stop()
+    _client, _AUTH_HEADERS = _openrouter_connection(_API_KEY)
 except Exception as e:
     st.error(f"Error configuring OpenRouter API: {e}")
     st.stop()
 
 
-# --- Function to get a suitable model from OpenRouter (Revised prioritization) ---
-# --- Function to get a suitable model from OpenRouter (Revised prioritization) ---
-# --- Function to get a suitable model from OpenRouter (Revised prioritization and AGGRESSIVE DEBUGGING) ---
-@st.cache_data(ttl=3600, show_spinner="Attempting to find a robust OpenRouter model...")
-def get_suitable_openrouter_model():
+# --- Per-request limits for chat completions (override the SDK's ~600 s default timeout) ---
+OPENROUTER_REQUEST_TIMEOUT = 60.0  # seconds
+OPENROUTER_MAX_RETRIES = 2
+
+
+# --- Preferred OpenRouter models, tried in order before falling back to listing ---
+PREFERRED_MODELS = (
+    "mistralai/mixtral-8x7b-instruct",
+    "openai/gpt-3.5-turbo",
+    "openai/gpt-4-turbo",
+    "mistralai/mistral-7b-instruct",
+    "anthropic/claude-sonnet-4.5",
+    "google/gemini-2.5-flash",
+)
+
+# OpenRouter error text meaning "this model id can't be used", as opposed to a bad request
+_MODEL_UNAVAILABLE_RE = re.compile(
+    r"not a valid model|invalid model|model not found|no endpoints found|no allowed providers"
+    r"|model .{0,80}(?:is not available|does not exist|has been deprecated|has been removed)",
+    re.I,
+)
+
+# Keywords in a model id indicating chat/instruction capability (used by the listing fallback)
+_CHAT_RE = re.compile(
+    r"chat|instruct|gpt|claude|gemini|llama|mistral|hermes|dpo|text-generation"
+    r"|command|qwen|mixtral|openhermes|codellama|glm|grok|deepseek",
+    re.I,
+)
+
+
+# --- Fallback: resolve a suitable model by listing OpenRouter (cached for the whole process) ---
+@st.cache_resource(ttl=3600, show_spinner="Attempting to find a robust OpenRouter model...")
+def _resolve_model_id(api_key):
     """
-    F etches available models from OpenRouter and selects a robust text generation one.
+    Fetches available models from OpenRouter and selects a robust text generation one.
     Prioritizes commonly used, reliable chat models.
+
+    Performs no Streamlit I/O so a cache hit is free; failures are raised as
+    RuntimeError (which is never cached) and rendered by the caller.
     """
     try:
-        headers = {"Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}"} # Ensure API key is correctly accessed
-        
-        st.info("Making API call to OpenRouter to list models...")
-        response = requests.get("https://openrouter.ai/api/v1/models", headers=headers)
+        response = _http_session().get("https://openrouter.ai/api/v1/models", headers=_openrouter_connection(api_key)[1])
         response.raise_for_status() 
-        
         models_data = response.json().get('data', [])
-        
-        if not models_data:
-            st.error("OpenRouter API returned an EMPTY list of models. This is highly unusual and suggests an issue with your API key or account.")
-            st.error("Please re-check your OpenRouter API key on your account dashboard and ensure you have sufficient credits/plan for any model to be listed.")
-            return None
-        
-        st.info(f"OpenRouter API returned {len(models_data)} raw models. (First 3 IDs: {[m.get('id') for m in models_data[:3]]})")
-
-        preferred_models_ids = [
-            "mistralai/mixtral-8x7b-instruct",
-            "openai/gpt-3.5-turbo",
-            "openai/gpt-4-turbo", 
-            "google/gemini-pro", 
-            "anthropic/claude-3-opus", 
-            "anthropic/claude-3-sonnet", 
-            "anthropic/claude-instant-v1",
-            "mistralai/mistral-7b-instruct",
-            "nousresearch/nous-hermes-2-mixtral-8x7b-dpo",
-            "meta-llama/llama-2-70b-chat", 
-            "databricks/dbrx-instruct",
-            "anthropic/claude-sonnet-4.5", # Explicitly adding one from your debug output
-            "google/gemini-2.5-flash-preview-09-2025" # Another from your output that looks promising
-        ]
-
-        selected_model_id = None
-        available_chat_models = []
-        
-        st.write("--- Attempting to filter models for chat capabilities (detailed log) ---")
-        
-        debug_log_limit = 20 
-        logged_models_count = 0
-
-        for model_config in models_data:
-            model_id = model_config.get('id')
-            architecture_config = model_config.get('architecture', {})
-            modality = architecture_config.get('modality')
-            context_length = model_config.get('context_length')
-
-            is_suitable = True
-            reasons_for_filter = []
-
-            # Check 1: Model ID must exist
-            if not model_id:
-                is_suitable = False
-                reasons_for_filter.append("Missing ID")
-            
-            # Check 2: Modality must indicate text output
-            # REVISED: Check if modality starts with 'text' or contains '->text'
-            if modality is None: # Modality might be missing for some models
-                is_suitable = False
-                reasons_for_filter.append("Modality is missing (None)")
-            elif not (modality.startswith('text') or '->text' in modality):
-                is_suitable = False
-                reasons_for_filter.append(f"Modality '{modality}' does not indicate text output")
-
-            # Check 3: Context length should exist and be reasonable
-            if not context_length or not isinstance(context_length, int) or context_length < 500: # Assuming minimal context for a chat model
-                is_suitable = False
-                reasons_for_filter.append(f"Invalid or missing context_length ({context_length})")
-
-            # Check 4: Keywords indicating chat/instruction capability
-            model_id_lower = model_id.lower() if model_id else ""
-            if not any(keyword in model_id_lower for keyword in 
-                       ['chat', 'instruct', 'gpt', 'claude', 'gemini', 'llama', 'mistral', 'hermes', 'dpo', 
-                        'text-generation', 'command', 'qwen', 'mixtral', 'openhermes', 'codellama', 'glm', 'grok', 'deepseek']):
-                is_suitable = False
-                reasons_for_filter.append(f"No chat/instruct keyword found in ID '{model_id}'")
-
-            if is_suitable:
-                available_chat_models.append(model_id)
-                if logged_models_count < debug_log_limit:
-                    st.write(f"✅ SUITABLE: `{model_id}` (Modality: {modality}, Context: {context_length})")
-                    logged_models_count += 1
-            else:
-                if logged_models_count < debug_log_limit:
-                    st.write(f"❌ FILTERED: `{model_id}` (Modality: {modality}, Context: {context_length}) - Reasons: {'; '.join(reasons_for_filter)}")
-                    logged_models_count += 1
-
-
-        if not available_chat_models:
-            st.error("Even after extensive filtering, no suitable chat/instruction-following text models were found for your API key.")
-            st.error("This suggests models might be unavailable or your filtering criteria are too strict for your account's access.")
-            return None
-
-        available_chat_models.sort() 
-
-        for preferred_id in preferred_models_ids:
-            if preferred_id in available_chat_models:
-                selected_model_id = preferred_id
-                break
-        
-        if not selected_model_id:
-            selected_model_id = available_chat_models[0] 
-            st.warning(f"No highly preferred model found among available chat models. Using first available: `{selected_model_id}`")
-
-        st.success(f"Successfully selected OpenRouter model: `{selected_model_id}`.")
-        return selected_model_id
-
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == 401:
-            st.error(f"OpenRouter API Key Unauthorized (401). Your OPENROUTER_API_KEY is likely incorrect or expired. Error: {e}")
-            st.error("Please go to your OpenRouter account, generate a NEW API KEY, and update your .env file.")
-        else:
-            st.error(f"Failed to fetch models from OpenRouter due to HTTP error {e.response.status_code}: {e}")
-            st.error(f"OpenRouter's response: {e.response.text}") 
-        return None
+            raise RuntimeError(f"OpenRouter API Key Unauthorized (401). Your OPENROUTER_API_KEY is likely incorrect or expired. "
+                               f"Please generate a NEW API KEY and update your .env file. Error: {e}") from e
+        raise RuntimeError(f"Failed to fetch models from OpenRouter due to HTTP error {e.response.status_code}: {e}. "
+                           f"OpenRouter's response: {e.response.text}") from e
     except requests.exceptions.ConnectionError as e:
-        st.error(f"Failed to connect to OpenRouter. Check your internet connection or firewall. Error: {e}")
-        return None
+        raise RuntimeError(f"Failed to connect to OpenRouter. Check your internet connection or firewall. Error: {e}") from e
     except requests.exceptions.RequestException as e:
-        st.error(f"An unknown request error occurred while fetching models from OpenRouter: {e}")
-        st.error("This usually means a problem with the API key or network.")
-        return None
-    except Exception as e:
-        st.error(f"An unexpected error occurred while selecting an OpenRouter model: {e}")
-        st.error("This could be due to unexpected data format from OpenRouter or other Python errors.")
-        return None
+        raise RuntimeError(f"An unknown request error occurred while fetching models from OpenRouter: {e}") from e
+    except ValueError as e:
+        raise RuntimeError(f"OpenRouter returned an unexpected (non-JSON) model list: {e}") from e
+
+    if not models_data:
+        raise RuntimeError("OpenRouter API returned an EMPTY list of models. "
+                           "Please re-check your OpenRouter API key and ensure you have sufficient credits/plan.")
+
+    available_chat_models = []
+    for model_config in models_data:
+        model_id = model_config.get('id')
+        modality = model_config.get('architecture', {}).get('modality')
+        context_length = model_config.get('context_length')
+
+        # Model ID must exist
+        if not model_id:
+            continue
+        # Modality must indicate text output
+        if modality is None or not (modality.startswith('text') or '->text' in modality):
+            continue
+        # Context length should exist and be reasonable
+        if not isinstance(context_length, int) or context_length < 500:
+            continue
+        # Keywords indicating chat/instruction capability
+        if not _CHAT_RE.search(model_id):
+            continue
+        available_chat_models.append(model_id)
+
+    if not available_chat_models:
+        raise RuntimeError("No suitable chat/instruction-following text models were found for your API key.")
+
+    for preferred_id in PREFERRED_MODELS:
+        if preferred_id in available_chat_models:
+            return preferred_id
+
+    # No highly preferred model available; fall back to the first one alphabetically
+    return min(available_chat_models)
+
+
+def _is_model_unavailable(error):
+    """True if an OpenRouter 404/400 says the model itself is unusable (so trying another model may help)."""
+    if isinstance(error, NotFoundError):
+        return True
+    return bool(_MODEL_UNAVAILABLE_RE.search(f"{error.message} {error.body}"))
+
+
+def _candidate_models():
+    """
+    Yields model ids to try in order: the one that last worked in this session,
+    then PREFERRED_MODELS. Only if none of those is available do we pay for the
+    /models listing via _resolve_model_id().
+    """
+    tried = set()
+    for model_id in (st.session_state.get("or_model"), *PREFERRED_MODELS):
+        if model_id and model_id not in tried:
+            tried.add(model_id)
+            yield model_id
+
+    model_id = _resolve_model_id(_API_KEY)  # May raise RuntimeError
+    if model_id not in tried:
+        yield model_id
 
     
-# --- get_openrouter_response() function (WITH AGGRESSIVE DEBUGGING) ---
-def get_openrouter_response(prompt_text):
-    """Sends a prompt to OpenRouter and returns the text response."""
+# --- get_openrouter_response() function (verbose output behind the sidebar "Debug" checkbox) ---
+def _stream_text(response_stream, stream_info=None):
+    """
+    Yields the text deltas of a streamed chat completion. If stream_info is given,
+    stream_info["finish_reason"] is set once the final chunk arrives.
+    """
+    for chunk in response_stream:
+        if chunk.choices:
+            choice = chunk.choices[0]
+            if choice.finish_reason and stream_info is not None:
+                stream_info["finish_reason"] = choice.finish_reason
+            yield choice.delta.content or ""
+
+
+def get_openrouter_response(prompt_text, max_tokens=1500, system_prompt=None, stream_info=None):
+    """
+    Sends a prompt (plus an optional system message) to OpenRouter and returns a
+    generator over the streamed text response (suitable for st.write_stream),
+    or None if the request failed. See _stream_text for stream_info.
+    """
     
     debug_status = st.empty() 
     
-    openrouter_client = client 
-    debug_status.info("DEBUG: Inside get_openrouter_response(). Attempting to get model ID.")
-
-    model_id = get_suitable_openrouter_model()
-    if not model_id:
-        debug_status.error("DEBUG: Model ID could NOT be retrieved. Returning None.")
-        return None 
-    
-    debug_status.info(f"DEBUG: Model ID successfully retrieved: `{model_id}`. Preparing API call.")
+    # Bounded per-request timeout; the SDK retries 429/5xx/connection errors with exponential backoff
+    openrouter_client = _client.with_options(
+        timeout=OPENROUTER_REQUEST_TIMEOUT, max_retries=OPENROUTER_MAX_RETRIES
+    )
 
     if not prompt_text or not prompt_text.strip():
-        debug_status.error("DEBUG: Prompt text is empty or only whitespace. Cannot send empty prompt to LLM.")
+        debug_status.error("There is nothing to send to OpenRouter: the prompt is empty.")
         return None
 
+    messages = [{"role": "user", "content": prompt_text}]
+    if system_prompt:
+        messages.insert(0, {"role": "system", "content": system_prompt})
+
+    model_id = None
     try:
-        debug_status.info(f"DEBUG: Sending chat completion request to OpenRouter with model `{model_id}`...")
-        response = openrouter_client.chat.completions.create(
-            model=model_id, 
-            messages=[
-                {"role": "user", "content": prompt_text}
-            ],
-            temperature=0.7, 
-            max_tokens=1500, 
-        )
-        debug_status.info("DEBUG: Chat completion request successful. Extracting content.")
-        
-        if response and response.choices and len(response.choices) > 0 and response.choices[0].message and response.choices[0].message.content is not None:
-            # Explicitly check for 'is not None' because an empty string '' is valid content
-            final_content = response.choices[0].message.content
-            if not final_content.strip(): # Check if content is just whitespace
-                debug_status.warning(f"DEBUG: Model `{model_id}` returned content, but it was empty or only whitespace. This may indicate a problem with the prompt or the model's ability to respond.")
-                st.write("Full OpenRouter response object:")
-                st.json(response.model_dump_json())
-            else:
-                debug_status.success("DEBUG: Successfully extracted non-empty content from OpenRouter response.")
-            return final_content
-        else:
-            debug_status.error("DEBUG: OpenRouter response was malformed or did not contain expected message content.")
-            st.write("Full OpenRouter response object:")
-            st.json(response.model_dump_json()) 
+        response = None
+        for model_id in _candidate_models():
+            if st.session_state.get("debug"):
+                debug_status.info(f"DEBUG: Sending chat completion request to OpenRouter with model `{model_id}`...")
+            try:
+                # Unavailable models are rejected before the first chunk, so probing still works with stream=True
+                response = openrouter_client.chat.completions.create(
+                    model=model_id, 
+                    messages=messages,
+                    temperature=0.7, 
+                    max_tokens=max_tokens, 
+                    stream=True,
+                )
+            except (NotFoundError, BadRequestError) as e:
+                # Any other 400 (context too long, bad parameters, ...) would fail on every model
+                if not _is_model_unavailable(e):
+                    raise
+                # Model unavailable for this key/account; try the next candidate
+                if st.session_state.get("debug"):
+                    debug_status.info(f"DEBUG: Model `{model_id}` unavailable ({e.status_code}). Trying next candidate.")
+                continue
+            st.session_state["or_model"] = model_id
+            break
+        if response is None:
+            debug_status.error("None of the OpenRouter models available to your API key accepted the request. Please try again later.")
             return None
+        if st.session_state.get("debug"):
+            debug_status.success(f"DEBUG: Streaming response from OpenRouter model `{model_id}`.")
+        return _stream_text(response, stream_info)
 
+    except RuntimeError as e:
+        debug_status.error(f"Could not find a usable OpenRouter model. {e}")
+        return None
+    except RateLimitError as e:
+        debug_status.error(f"OpenRouter is rate limiting requests for model '{model_id}' (429) even after retrying. Please wait a moment and try again.")
+        if st.session_state.get("debug"):
+            st.exception(e)
+        return None
+    except APITimeoutError as e:
+        debug_status.error(f"OpenRouter did not respond within {OPENROUTER_REQUEST_TIMEOUT:.0f} seconds for model '{model_id}'. Please try again.")
+        if st.session_state.get("debug"):
+            st.exception(e)
+        return None
     except Exception as e:
-        debug_status.error(f"DEBUG: An EXCEPTION occurred during OpenRouter API call with model '{model_id}': {e}")
-        import traceback
-        st.exception(e) 
-        debug_status.error("DEBUG: Check the console/Streamlit for detailed traceback above.")
+        debug_status.error(f"The request to OpenRouter (model '{model_id}') failed: {e}")
+        if st.session_state.get("debug"):
+            st.exception(e) 
         return None
 
 
-# --- Main Itinerary Organization Function (uses OpenRouter now) ---
-# --- Main Itinerary Organization Function (uses OpenRouter now) ---
-def organize_itinerary_with_openrouter(raw_itinerary_components, num_days_str="3N 4D"):
+# --- Deterministic pre-processing: parse raw components and lay them out per day ---
+_SECTION_RE = re.compile(r"^\s*([A-Za-z][\w &/()-]*?)\s*:\s*$")  # Any "Word:" header line
+_ACTIVITY_KEYWORDS = ("tour", "activit", "sightseeing", "excursion", "inclusion")
+_ITEM_RE = re.compile(r"^\s*-\s*(.+?)\s*$")
+_BASIS_RE = re.compile(r"\s*\*\*.*?\*\*")  # e.g. "** SIC Basis  **"
+_DAYS_RE = re.compile(r"(\d{1,6})\s*D(?:ays?)?\b", re.I)
+_NIGHTS_RE = re.compile(r"(\d{1,6})\s*N(?:ights?)?\b", re.I)
+_WEEKS_RE = re.compile(r"(\d{1,6})\s*W(?:ee)?ks?\b", re.I)
+MAX_TRIP_DAYS = 30  # Free-text durations beyond this are clamped (prompt size, output budget)
+_DAY1_OR = re.compile(r"🗓️Day 1 :.*", re.DOTALL)  # Strips any preamble before the itinerary
+
+
+def _parse_num_days(num_days_str):
+    """
+    Extracts the number of days from a duration like "3N 4D", "5 days", "3 nights" or
+    "1 week"; None if absent. The result is not clamped (see MAX_TRIP_DAYS).
     """
-    Leverages OpenRouter (using a specified model) to organize raw itinerary components
-    into a structured, day-by-day format with desired beautification and constraints.
+    match = _DAYS_RE.search(num_days_str or "")
+    if match:
+        return max(1, int(match.group(1)))
+    match = _NIGHTS_RE.search(num_days_str or "")
+    if match:
+        return int(match.group(1)) + 1
+    match = _WEEKS_RE.search(num_days_str or "")
+    if match:
+        return max(1, 7 * int(match.group(1)))
+    return None
+
+
+def _max_tokens_for(num_days):
+    """Output budget scaled to trip length (~120 tokens per day plus headroom), capped at 1500."""
+    if num_days is None:
+        return 1500
+    return min(1500, 120 * num_days + 200)
+
+
+def _section_kind(header):
+    """Classifies a "Word:" header as "transfers", "activities" or "other" by keyword."""
+    lowered = header.lower()
+    if "transfer" in lowered:
+        return "transfers"
+    if any(keyword in lowered for keyword in _ACTIVITY_KEYWORDS):
+        return "activities"
+    return "other"
+
+
+def _parse_raw(raw_itinerary_components):
     """
+    Single pass over the pasted text. Returns (tours, extras, arrivals, departures):
+    - tours: lines under an activity header such as Tours:, Tours & Activities:,
+      Sightseeing Tours: or Inclusions: (or before any header), bulleted or not, with
+      their "** ... Basis **" markers stripped;
+    - arrivals/departures: transfer lines (other than tour transfers) mentioning the
+      arrival or departure, kept verbatim so times and service level reach the model;
+    - extras: every other line (tour transfers, hotels, notes, ...), kept verbatim so
+      nothing pasted is silently lost.
+    """
+    tours, extras, arrivals, departures = [], [], [], []
+    section = None
+    for line in raw_itinerary_components.splitlines():
+        if not line.strip():
+            continue
+        header = _SECTION_RE.match(line)
+        if header:
+            section = _section_kind(header.group(1))
+            continue
+        item = _ITEM_RE.match(line)
+        text = item.group(1) if item else line.strip()
+        if section in (None, "activities"):
+            text = _BASIS_RE.sub("", text).strip()
+            if text:
+                tours.append(text)
+            continue
+        lowered = text.lower()
+        # "Tour Transfer ... departure 7pm" is a tour pickup, not the trip's departure
+        if section == "transfers" and "tour" not in lowered:
+            if "arrival" in lowered:
+                arrivals.append(text)
+            if "departure" in lowered:
+                departures.append(text)
+            if "arrival" in lowered or "departure" in lowered:
+                continue
+        extras.append(text)
+    return tours, extras, arrivals, departures
+
+
+def _allocate(tours, num_days, arrivals=(), departures=()):
+    """
+    Spreads tours over the trip in order, returning one list of activities per day.
+    Tours fill the days before a departure day as evenly as possible, with any
+    remainder going to the middle days before the arrival day, which already
+    carries the arrival transfer(s). The last day closes with the departure transfer(s).
+    """
+    days = [[] for _ in range(num_days)]
+    tour_days = num_days - 1 if (departures and num_days > 1) else num_days
+    per_day, extra = divmod(len(tours), tour_days)
+    fill_order = list(range(1, tour_days)) + [0] if arrivals else list(range(tour_days))
+    heavier_days = set(fill_order[:extra])
+    start = 0
+    for day_index in range(tour_days):
+        end = start + per_day + (1 if day_index in heavier_days else 0)
+        days[day_index].extend(tours[start:end])
+        start = end
+    days[0][:0] = [f"Arrival transfer: {text}" for text in arrivals]
+    days[-1].extend(f"Departure transfer: {text}" for text in departures)
+    return days
+
+
+# --- Cache of finished itineraries keyed by (raw input, duration) ---
+ITINERARY_CACHE_TTL = 24 * 60 * 60  # seconds
+ITINERARY_CACHE_MAX_ENTRIES = 128
+
+
+@st.cache_resource
+def _itinerary_cache():
+    """
+    Process-wide (lock, OrderedDict) store shared across sessions. Not st.cache_data:
+    the first generation streams into the page, and st.cache_data would replay
+    every element emitted during that run on each cache hit.
+    """
+    return threading.Lock(), OrderedDict()
+
+
+def _cache_key(raw_itinerary_components, num_days_str):
+    return raw_itinerary_components.strip(), num_days_str.strip()
 
-    prompt = f"""
-    You are an expert travel agent assistant. Your task is to take raw itinerary components and organize them into a structured, day-by-day plan.
-
-    Here are the raw itinerary components:
-    {raw_itinerary_components}
-
-    The trip duration is {num_days_str}.
-
-    Please format the output *strictly* as follows for easy copy-pasting:
-    - Each day starts with: 🗓️Day "n" : One liner brief of the day
-    - Each activity point starts with: → (use the arrow symbol, not bullet points)
-    - **CRITICAL:** Each activity point MUST be on its own separate line. Absolutely no two points should share the same line.
-    - Each day (except departure day if it has minimal activities) must have a minimum of 3 to 4 clearly detailed and catchy points.
-    - After significant tours or activities, **always add a point like "→ Transfer back to your hotel for relaxation."** or similar, ensuring a complete daily flow.
-    - EXCEPTION: For days that are primarily "Departure" days with no significant activities other than transfer, limit the points to a maximum of 2, ensuring they are concise and brief.
-
-    Here is an example of the desired format for a day (ensure you follow the "→" arrow strictly, and note each point is on a new line):
-    🗓️Day 1 : Arrival & Enchanting City Discoveries
-    → Arrive in Singapore and enjoy a seamless private transfer to your hotel.
-    → Embark on a comprehensive 3-hour City Tour, uncovering Singapore's vibrant heart.
-    → Capture stunning photos at iconic landmarks like the majestic Singapore Flyer.
-    → Drive past architectural gems including Raffles Hotel and the poignant War Memorial Park.
-    → Conclude your city insights with a visit to a charming Gift Shop and explore Chinatown.
-    → Transfer back to your hotel for relaxation after a day of exploration.
-
-    Please ensure all the provided tours and transfers are incorporated logically into the {num_days_str} duration.
-    Focus on creating engaging and appealing descriptions for each point.
-    Do not include any introductory or concluding remarks outside the formatted itinerary. Just output the itinerary.
+
+def _get_cached_itinerary(key):
+    """Returns the cached itinerary for key, or None if missing or expired."""
+    lock, cache = _itinerary_cache()
+    with lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        stored_at, itinerary = entry
+        if time.monotonic() - stored_at > ITINERARY_CACHE_TTL:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return itinerary
+
+
+def _store_itinerary(key, itinerary):
+    lock, cache = _itinerary_cache()
+    with lock:
+        cache[key] = (time.monotonic(), itinerary)
+        cache.move_to_end(key)
+        while len(cache) > ITINERARY_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+
+# --- Static instructions, sent verbatim as the system message so providers can cache the prefix ---
+ITINERARY_SYSTEM_PROMPT = """You are an expert travel agent assistant. You will receive either a trip whose activities are already assigned to days, or raw itinerary components to organize logically across the trip's duration.
+
+Rewrite each day into catchy points, formatted *strictly* as follows for easy copy-pasting:
+- Each day starts with: 🗓️Day "n" : One liner brief of the day
+- Each point starts with → and MUST be on its own separate line.
+- 3 to 4 points per day; after tours add "→ Transfer back to your hotel for relaxation." or similar.
+- Departure days with only a transfer: at most 2 concise points.
+
+Example:
+🗓️Day 1 : Arrival & Enchanting City Discoveries
+→ Arrive in Singapore and enjoy a seamless private transfer to your hotel.
+→ Embark on a comprehensive 3-hour City Tour, uncovering Singapore's vibrant heart.
+→ Transfer back to your hotel for relaxation after a day of exploration.
+
+Output only the itinerary, with no introductory or concluding remarks."""
+
+
+# --- Main Itinerary Organization Function (uses OpenRouter now) ---
+def organize_itinerary_with_openrouter(raw_itinerary_components, num_days_str="3N 4D", use_cache=True):
     """
-    
-    st.expander("Show Generated Prompt").code(prompt)
-
-    with st.spinner("Crafting your perfect itinerary using OpenRouter..."):
-        openrouter_output = get_openrouter_response(prompt)
-
-    if openrouter_output:
-        st.success("DEBUG: OpenRouter successfully returned output. Attempting regex match.")
-        match = re.search(r'🗓️Day 1 :.*', openrouter_output, re.DOTALL)
-        if match:
-            cleaned_output = match.group(0)
-            st.success("DEBUG: Regex match found.")
-            return cleaned_output
-        else:
-            st.warning("DEBUG: Regex match NOT found for '🗓️Day 1 :'. Displaying full output.")
-            st.markdown("--- Full raw OpenRouter output (no regex match) ---")
-            st.markdown(openrouter_output)
-            st.markdown("--- End raw output ---")
-            return openrouter_output 
+    Lays raw itinerary components out day-by-day in Python, then asks OpenRouter
+    only to beautify the pre-assigned points into the desired format.
+    Identical (raw input, duration) submissions are served from the cache unless
+    use_cache is False; only complete, well-formed itineraries are cached.
+    """
+    cache_key = _cache_key(raw_itinerary_components, num_days_str)
+    cached_itinerary = _get_cached_itinerary(cache_key) if use_cache else None
+    if cached_itinerary is not None:
+        st.subheader("✨ Your Organized Itinerary:")
+        st.markdown(cached_itinerary)
+        return cached_itinerary
+
+    duration_label = num_days_str
+    num_days = _parse_num_days(num_days_str)
+    if num_days is None:
+        st.warning(f"Couldn't read a number of days from \"{num_days_str}\", so the model will decide how to "
+                   "spread the trip. Use a format like \"3N 4D\", \"5 days\" or \"3 nights\" for an exact plan.")
+    elif num_days > MAX_TRIP_DAYS:
+        st.warning(f"Trips are limited to {MAX_TRIP_DAYS} days, so this itinerary covers the first {MAX_TRIP_DAYS}.")
+        num_days = MAX_TRIP_DAYS
+        duration_label = f"{MAX_TRIP_DAYS}D"
+
+    tours, extras, arrivals, departures = _parse_raw(raw_itinerary_components)
+    if tours and num_days:
+        day_plan = "\n".join(
+            f"Day {n}: [{' | '.join(activities) or 'Leisure day at your own pace'}]"
+            for n, activities in enumerate(_allocate(tours, num_days, arrivals, departures), start=1)
+        )
+        prompt = (
+            f"The activities for this {duration_label} trip are already assigned to days; "
+            f"keep every activity on its assigned day:\n{day_plan}"
+        )
+        if extras:
+            # Anything the parser did not place goes through verbatim
+            prompt += "\n\nAlso work these details into the most fitting days:\n" + "\n".join(f"- {x}" for x in extras)
     else:
-        st.error("DEBUG: get_openrouter_response() returned None. Itinerary could not be generated.")
+        # No recognisable tours or no usable day count: let the model lay out the raw text itself
+        prompt = (
+            f"Organize these raw itinerary components into a day-by-day plan for a {duration_label} trip, "
+            f"incorporating all the provided tours and transfers:\n{raw_itinerary_components.strip()}"
+        )
+    
+    if st.session_state.get("debug"):
+        st.expander("Show Generated Prompt").code(prompt)
+
+    with st.spinner("Connecting to OpenRouter..."):
+        stream_info = {}
+        response_stream = get_openrouter_response(
+            prompt, max_tokens=_max_tokens_for(num_days), system_prompt=ITINERARY_SYSTEM_PROMPT,
+            stream_info=stream_info,
+        )
+
+    if response_stream is None:
+        # get_openrouter_response() has already shown the user why the request failed
+        if st.session_state.get("debug"):
+            st.info("DEBUG: get_openrouter_response() returned None; skipping itinerary rendering.")
         return "Could not generate itinerary. Please try again."
 
+    st.subheader("✨ Your Organized Itinerary:")
+    output_area = st.empty()
+    try:
+        openrouter_output = output_area.write_stream(response_stream)
+    except Exception as e:
+        st.error(f"The connection to OpenRouter dropped while the itinerary was being written: {e}")
+        if st.session_state.get("debug"):
+            st.exception(e)
+        return "Could not generate itinerary. Please try again."
 
-# --- Streamlit UI Layout (remains the same from here down) ---
-st.set_page_config(
-    page_title="AI-Powered Itinerary Organizer",
-    page_icon="✈️",
-    layout="wide"
-)
+    if not openrouter_output or not openrouter_output.strip():
+        st.warning("The model returned an empty response. Please try again.")
+        return "Could not generate itinerary. Please try again."
+
+    completed = stream_info.get("finish_reason") == "stop"
+    if not completed:
+        st.warning("The itinerary may be cut off before the end. Click \"Regenerate\" to try again.")
+
+    match = _DAY1_OR.search(openrouter_output)
+    if match:
+        # Replace the streamed text with the version stripped of any preamble
+        cleaned_output = match.group(0)
+        output_area.markdown(cleaned_output)
+        if completed:
+            _store_itinerary(cache_key, cleaned_output)
+        return cleaned_output
+    else:
+        # Not in the expected format: shown as-is but never cached, so a retry asks the model again
+        if st.session_state.get("debug"):
+            st.warning("DEBUG: Regex match NOT found for '🗓️Day 1 :'. Displaying full output.")
+        return openrouter_output 
 
+
+# --- Streamlit UI Layout (remains the same from here down) ---
 st.title("✈️ AI-Powered Itinerary Organizer (via OpenRouter)")
 st.markdown("""
     Welcome to your personal itinerary assistant!
@@ -291,6 +545,9 @@ st.markdown("""
     following your desired format, powered by OpenRouter.
 """)
 
+# Debug output (prompt, model probing, tracebacks) is opt-in to keep normal reruns light
+st.sidebar.checkbox("Debug", key="debug")
+
 st.subheader("Trip Duration")
 duration_options = ["2N 3D", "3N 4D", "4N 5D", "5N 6D", "6N 7D", "7N 8D", "Custom"]
 selected_duration = st.selectbox(
@@ -330,11 +587,18 @@ raw_itinerary_text = st.text_area(
     height=300
 )
 
-if st.button("Organize Itinerary", type="primary"):
+organize_clicked = st.button("Organize Itinerary", type="primary")
+regenerate_clicked = st.button(
+    "Regenerate",
+    help="Ignore any cached itinerary for these details and ask the model for a fresh one."
+)
+
+if organize_clicked or regenerate_clicked:
     if raw_itinerary_text.strip():
-        organized_itinerary = organize_itinerary_with_openrouter(raw_itinerary_text, num_days_str=duration_to_use)
-        st.subheader("✨ Your Organized Itinerary:")
-        st.markdown(organized_itinerary)
+        # Renders the itinerary progressively as it streams in
+        organize_itinerary_with_openrouter(
+            raw_itinerary_text, num_days_str=duration_to_use, use_cache=not regenerate_clicked
+        )
     else:
         st.warning("Please enter some raw itinerary details to get started!")
 